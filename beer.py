@@ -1,28 +1,368 @@
+import os
 import re
+import gzip
+import hmac
+import json
+import math
+import time
+import base64
+import hashlib
+import binascii
 import datetime
-
-from flask import Flask, request, jsonify, abort
+import threading
+from functools import wraps
+from itertools import groupby
+from cStringIO import StringIO
+from collections import OrderedDict, deque, namedtuple
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from flask import Flask, Response, request, jsonify, abort, g, stream_with_context
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import joinedload, contains_eager
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy import select, func, tuple_, literal, literal_column, bindparam
 from sqlalchemy.ext.hybrid import hybrid_property
 
 app = Flask(__name__)
 app.config['DEBUG'] = True
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres://Penguin:@localhost:5432/beer'
 #app.config['SQLALCHEMY_ECHO'] = True
+app.config['PASSWORD_HASH_ITERATIONS'] = 100000
+app.config['PASSWORD_HASH_WORKERS'] = None       #defaults to one per core
+app.config['PASSWORD_HASH_TIMEOUT'] = 30
+#signs every bearer token; all workers must share it, so there is no fallback
+app.config['SECRET_KEY'] = os.environ.get('BEER_SECRET_KEY')
+if not app.config['SECRET_KEY']:
+    raise RuntimeError('BEER_SECRET_KEY must be set')
+app.config['TOKEN_TTL'] = 24 * 60 * 60
+app.config['TOKEN_CACHE_SIZE'] = 10000
+#(requests, per seconds) allowed per client and route; RATELIMIT_ROUTES overrides by endpoint
+app.config['RATELIMIT_READ'] = (120, 60)
+app.config['RATELIMIT_WRITE'] = (30, 60)
+app.config['RATELIMIT_ROUTES'] = {'login': (10, 60)}
+app.config['RATELIMIT_STORE'] = None            #defaults to a MemoryRateLimitStore
+app.config['SHED_MAX_INFLIGHT'] = 64
+app.config['SHED_DB_POOL_RATIO'] = 0.9
+app.config['PURGE_BATCH_SIZE'] = 1000
+app.config['PURGE_INTERVAL'] = 60
+app.config['TRENDING_REFRESH'] = 30
+app.config['CHANGE_FEED_POLL'] = 0.5
+app.config['CHANGE_FEED_SETTLE'] = 5             #seconds a gap in change ids may still be an uncommitted write
+app.config['CHANGE_FEED_TAIL'] = 10000
+app.config['SHED_EXEMPT'] = set(['changes'])     #long-lived, mostly idle requests that don't count as in flight
+app.config['CHANGE_FEED_MAX_SUBSCRIBERS'] = 32    #open /changes requests per process; each holds a thread unless under gevent
+app.config['BATCH_MAX_KEYS'] = 300
+app.config['RESPONSE_CACHE_BYTES'] = 64 * 1024 * 1024
+app.config['RESPONSE_CACHE_TTL'] = 60            #bounds staleness from writes handled by other workers
+app.config['RESPONSE_CACHE_GZIP_MIN'] = 1024     #bodies at least this long are also kept gzipped
 
 db = SQLAlchemy(app)
 
 favorites = db.Table('Favorites',
-    db.Column('user_id', db.Integer, db.ForeignKey('Users.id', ondelete='CASCADE')),
-    db.Column('beer_id', db.Integer, db.ForeignKey('Beers.id', ondelete='CASCADE'))
+    db.Column('user_id', db.Integer, db.ForeignKey('Users.id', ondelete='CASCADE'), index=True),
+    db.Column('beer_id', db.Integer, db.ForeignKey('Beers.id', ondelete='CASCADE'), index=True)
 )
 
 def slugify(text):
     return re.sub('[^A-Za-z0-9]+', '-', text)
 
+def brewery_slug(name):
+    #case-insensitive, so 'New Glarus' and 'new glarus' land on the same brewery
+    return slugify(name.strip()).strip('-').lower()
+
+#
+# password hashing
+#
+# pbkdf2 is deliberately slow, so it runs in a bounded pool rather than inline:
+# a burst of logins queues up behind PASSWORD_HASH_WORKERS threads instead of
+# pinning every core. hashlib releases the GIL while it hashes.
+
+PASSWORD_SCHEME = 'pbkdf2_sha256'
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+def _password_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPool(app.config['PASSWORD_HASH_WORKERS'] or cpu_count())
+    return _hash_pool
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _pbkdf2(password, salt, iterations):
+    return binascii.hexlify(hashlib.pbkdf2_hmac('sha256', _to_bytes(password), salt, iterations))
+
+def _pooled_pbkdf2(password, salt, iterations):
+    job = _password_pool().apply_async(_pbkdf2, (password, salt, iterations))
+    return job.get(app.config['PASSWORD_HASH_TIMEOUT'])
+
+def hash_password(password, iterations=None):
+    """Returns a salted 'pbkdf2_sha256$iterations$salt$hash' string for password."""
+    iterations = iterations or app.config['PASSWORD_HASH_ITERATIONS']
+    salt = binascii.hexlify(os.urandom(16))
+    return '%s$%d$%s$%s' % (PASSWORD_SCHEME, iterations, salt, _pooled_pbkdf2(password, salt, iterations))
+
+def verify_password(password, stored):
+    """Checks password against a stored hash. Returns (matches, needs_rehash).
+
+    Values without the scheme prefix are legacy plaintext rows; they still
+    verify, but always need rehashing.
+    """
+    stored = _to_bytes(stored or '')
+    try:
+        scheme, iterations, salt, expected = stored.split('$')
+        iterations = int(iterations)
+    except ValueError:
+        return hmac.compare_digest(stored, _to_bytes(password)), True
+
+    if scheme != PASSWORD_SCHEME:
+        return False, False
+
+    matches = hmac.compare_digest(_pooled_pbkdf2(password, salt, iterations), expected)
+    return matches, iterations < app.config['PASSWORD_HASH_ITERATIONS']
+
+#
+# bearer tokens
+#
+# A token is <payload>.<signature>: urlsafe base64 of the json claims
+# {'sub': user id, 'jti': token id, 'iat': issued at, 'exp': expires at}
+# and of their HMAC-SHA256 under SECRET_KEY. Verification needs no database;
+# verified claims are kept in an LRU so repeat requests skip the HMAC and json
+# work, and only the expiry and revocation checks run per request.
+# Revocations live in process memory, so each worker tracks its own.
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip('=')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(_to_bytes(text) + '=' * (-len(text) % 4))
+
+def _sign(payload):
+    return _b64encode(hmac.new(_to_bytes(app.config['SECRET_KEY']), payload, hashlib.sha256).digest())
+
+class TokenCache(object):
+    """LRU of verified token claims plus the revocation lists they are checked against."""
+
+    def __init__(self, size):
+        self.size = size
+        self._claims = OrderedDict()
+        self._revoked = {}              #jti -> exp, dropped once the token would have expired anyway
+        self._revoked_users = {}        #user id -> tokens issued before this time are dead
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            claims = self._claims.pop(token, None)
+            if claims is not None:
+                self._claims[token] = claims
+            return claims
+
+    def put(self, token, claims):
+        with self._lock:
+            self._claims[token] = claims
+            while len(self._claims) > self.size:
+                self._claims.popitem(last=False)
+
+    def revoke(self, claims):
+        now = time.time()
+        with self._lock:
+            for jti, exp in self._revoked.items():
+                if exp < now:
+                    del self._revoked[jti]
+            self._revoked[claims['jti']] = claims['exp']
+
+    def revoke_user(self, user_id):
+        with self._lock:
+            self._revoked_users[user_id] = time.time()
+
+    def is_revoked(self, claims):
+        return claims['jti'] in self._revoked or claims['iat'] <= self._revoked_users.get(claims['sub'], 0)
+
+token_cache = TokenCache(app.config['TOKEN_CACHE_SIZE'])
+
+def issue_token(user_id):
+    """Returns a signed (token, claims) pair for user_id."""
+    now = time.time()
+    claims = {
+        'sub': user_id,
+        'jti': binascii.hexlify(os.urandom(12)),
+        'iat': now,
+        'exp': int(now) + app.config['TOKEN_TTL']
+    }
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')))
+    return payload + '.' + _sign(payload), claims
+
+def verify_token(token):
+    """Returns the claims of a correctly signed, unexpired, unrevoked token, else None."""
+    claims = token_cache.get(token)
+    if claims is None:
+        try:
+            payload, signature = _to_bytes(token).split('.')
+            if not hmac.compare_digest(_sign(payload), signature):
+                return None
+            claims = json.loads(_b64decode(payload))
+        except (ValueError, TypeError):
+            return None
+        token_cache.put(token, claims)
+
+    if claims['exp'] < time.time() or token_cache.is_revoked(claims):
+        return None
+    return claims
+
+def login_required(view):
+    """Rejects requests without a valid bearer token. The token's user id is left in g.user_id."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        claims = None
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            claims = verify_token(auth[len('Bearer '):].strip())
+        if claims is None:
+            return jsonify({'error': 'missing or invalid token'}), 401
+
+        g.user_id = claims['sub']
+        g.token = claims
+        return view(*args, **kwargs)
+    return wrapper
+
+def token_user_deleted():
+    """Whether g.user_id has been deleted since its token was issued.
+
+    Revocation only reaches the worker that deleted the user, so views that
+    attach new rows to g.user_id check the user row itself.
+    """
+    if User.active().filter_by(id=g.user_id).count():
+        return False
+    #spares this worker the lookup on the token's next use
+    token_cache.revoke_user(g.user_id)
+    return True
+
+#
+# rate limiting and load shedding
+#
+# Both run as before_request hooks, so an overloaded or over-eager client is
+# turned away before its request does any database work.
+
+class MemoryRateLimitStore(object):
+    """Token buckets held in this process, keyed by client and route."""
+
+    max_keys = 100000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        """Takes a token from key's bucket. Returns 0 if one was available, else seconds until one is."""
+        now = time.time()
+        rate = float(capacity) / period
+        with self._lock:
+            tokens, stamp, _ = self._buckets.get(key, (capacity, now, period))
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now, period)
+            else:
+                self._buckets[key] = (tokens, now, period)
+            if len(self._buckets) > self.max_keys:
+                self._sweep(now)
+        return 0 if tokens >= 1 else (1 - tokens) / rate
+
+    def _sweep(self, now):
+        #a bucket untouched for its whole period has refilled, so forgetting it changes nothing
+        live = []
+        for key, (tokens, stamp, period) in self._buckets.items():
+            if now - stamp > period:
+                del self._buckets[key]
+            else:
+                live.append((stamp, key))
+
+        #still crowded with live clients: forget the least recently seen ones (they
+        #start over with a full bucket), leaving room so sweeps stay infrequent
+        excess = len(live) - int(self.max_keys * 0.9)
+        if excess > 0:
+            live.sort()
+            for stamp, key in live[:excess]:
+                del self._buckets[key]
+
+class SharedRateLimitStore(MemoryRateLimitStore):
+    """Token buckets in a mapping shared between worker processes.
+
+    Any dict-like mapping and lock pair works; multiprocessing.Manager().dict()
+    and .Lock() created before the workers fork is the local stand-in for a
+    networked store.
+    """
+
+    def __init__(self, mapping, lock):
+        self._buckets = mapping
+        self._lock = lock
+
+def rate_limit_store():
+    store = app.config['RATELIMIT_STORE']
+    if store is None:
+        store = app.config['RATELIMIT_STORE'] = MemoryRateLimitStore()
+    return store
+
+_inflight = [0]
+_inflight_lock = threading.Lock()
+
+def _db_pool_saturated():
+    pool = db.engine.pool
+    try:
+        if pool._max_overflow < 0:
+            return False
+        capacity = pool.size() + pool._max_overflow
+    except AttributeError:      #pools that never queue (e.g. sqlite's)
+        return False
+    return pool.checkedout() >= capacity * app.config['SHED_DB_POOL_RATIO']
+
+@app.before_request
+def shed_load():
+    """Answers 503 straight away when this worker already has too much in flight."""
+    with _inflight_lock:
+        if _inflight[0] >= app.config['SHED_MAX_INFLIGHT'] or _db_pool_saturated():
+            response = jsonify({'error': 'server is busy, try again shortly'})
+            response.status_code = 503
+            response.headers['Retry-After'] = '1'
+            return response
+        if request.endpoint in app.config['SHED_EXEMPT']:
+            return
+        _inflight[0] += 1
+    g.inflight = True
+
+@app.teardown_request
+def release_load(exc):
+    if getattr(g, 'inflight', False):
+        with _inflight_lock:
+            _inflight[0] -= 1
+
+@app.before_request
+def rate_limit():
+    """Answers 429 when the client has used up its bucket for this route."""
+    client = request.remote_addr
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        claims = verify_token(auth[len('Bearer '):].strip())
+        if claims is not None:
+            client = 'user:%s' % claims['sub']
+
+    limit = app.config['RATELIMIT_ROUTES'].get(request.endpoint)
+    if limit is None:
+        limit = app.config['RATELIMIT_READ'] if request.method in ('GET', 'HEAD') else app.config['RATELIMIT_WRITE']
+
+    retry_after = rate_limit_store().take('%s:%s' % (client, request.endpoint), *limit)
+    if retry_after:
+        response = jsonify({'error': 'rate limit exceeded'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+
 #User Model
 class User(db.Model):
     __tablename__ = 'Users'
@@ -30,18 +370,40 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255))
     username = db.Column(db.String(255), unique=True)
-    password = db.Column(db.String(255))
+    _password = db.Column('password', db.String(255))
     favorite_beers = db.relationship('Beer', secondary=favorites, lazy='dynamic')
+    #set by DELETE; the purger removes the row and everything hanging off it later
+    deleted_at = db.Column(db.DateTime, index=True)
+
+    @classmethod
+    def active(cls):
+        """Query over users that have not been deleted."""
+        return cls.query.filter(cls.deleted_at == None)
+
+    @property
+    def password(self):
+        return self._password
+
+    @password.setter
+    def password(self, value):
+        self._password = hash_password(value)
+
+    def check_password(self, password):
+        """Verifies password, upgrading the stored hash if its work factor is out of date."""
+        matches, needs_rehash = verify_password(password, self._password)
+        if matches and needs_rehash:
+            self.password = password
+        return matches
 
     def to_dict(self, include_rating=False):
         d = {
             'email': self.email,
             'username': self.username,
-            'password': self.password,
         }
 
         if include_rating:
-            d['ratings'] = [r.to_dict(include_beer=True) for r in self.ratings.all()]        #add rating to the user field if rating is true. diff between this and beer
+            ratings = self.ratings.options(joinedload(Rating.beer))
+            d['ratings'] = [r.to_dict(include_beer=True) for r in ratings.all()]        #add rating to the user field if rating is true. diff between this and beer
         return d
 
  
@@ -70,6 +432,68 @@ class Glass(db.Model):
         return d
 
 
+#Brewery model
+class Brewery(db.Model):
+    """A brewery, with catalog statistics rolled up as beers and ratings are written."""
+    __tablename__ = 'Breweries'
+
+    id = db.Column(db.Integer, primary_key= True)
+    _name = db.Column(db.String(255), unique=True)
+    slug = db.Column(db.String(255), unique=True)
+    beer_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def brewery_name(self):
+        return self._name
+
+    @brewery_name.setter
+    def brewery_name(self, value):
+        self._name = value
+        self.slug = brewery_slug(value)
+
+    @classmethod
+    def for_name(cls, name):
+        """Returns the brewery matching name locked for update, creating it if needed."""
+        with db.session.no_autoflush:
+            brewery = cls.query.with_for_update().populate_existing().filter_by(slug=brewery_slug(name)).first()
+        if brewery is None:
+            brewery = cls(brewery_name=name, beer_count=0, rating_count=0, rating_sum=0)
+            db.session.add(brewery)
+        return brewery
+
+    @classmethod
+    def for_id(cls, brewery_id):
+        """Returns the brewery locked for update."""
+        return cls.query.with_for_update().populate_existing().filter_by(id=brewery_id).one()
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes every brewery's statistics from the beers and ratings tables."""
+        rated = Rating.__table__.join(Beer.__table__, Rating.beer_id == Beer.id)
+        cls.query.update({
+            'beer_count': select([func.count(Beer.id)]).where(Beer.brewery_id == cls.id).where(Beer.deleted_at == None).as_scalar(),
+            'rating_count': select([func.count(Rating.id)]).select_from(rated).where(Beer.brewery_id == cls.id).as_scalar(),
+            'rating_sum': select([func.coalesce(func.sum(Rating.average), 0)]).select_from(rated).where(Beer.brewery_id == cls.id).as_scalar()
+        }, synchronize_session=False)
+
+    def apply(self, rating, sign=1):
+        """Adds (sign=1) or retracts (sign=-1) a rating of one of this brewery's beers."""
+        self.rating_count += sign
+        self.rating_sum += sign * rating.average
+
+    def to_dict(self):
+        d = {
+        'brewery_name': self.brewery_name,
+        'slug': self.slug,
+        'beer_count': self.beer_count,
+        'rating_count': self.rating_count,
+        'average_rating': round(float(self.rating_sum) / self.rating_count, 2) if self.rating_count else 0
+        }
+        return d
+
+
 #Beer Model 
 class Beer(db.Model):
     __tablename__ = 'Beers'
@@ -80,7 +504,8 @@ class Beer(db.Model):
     ibu = db.Column(db.Integer)
     calories = db.Column(db.Integer)
     abv = db.Column(db.Float(2), db.CheckConstraint('abv >= 0'), db.CheckConstraint('abv <= 100'))
-    brewery = db.Column(db.String(255))
+    brewery_id = db.Column(db.Integer, db.ForeignKey('Breweries.id'), index=True)
+    brewery = db.relationship('Brewery', foreign_keys=[brewery_id], backref=db.backref('beers', lazy='dynamic', viewonly=True))
     #foreign keys and relationships
     glass_id = db.Column(db.Integer, db.ForeignKey('Glasses.id'))
     glass = db.relationship('Glass', foreign_keys=[glass_id], backref=db.backref('beers', lazy='dynamic', viewonly=True))
@@ -88,6 +513,12 @@ class Beer(db.Model):
     created_at = db.Column(db.DateTime, default=db.func.now())
     created_by_id = db.Column(db.Integer, db.ForeignKey('Users.id', ondelete='SET NULL'))
     created_by = db.relationship('User', foreign_keys=[created_by_id])
+    deleted_at = db.Column(db.DateTime, index=True)
+
+    @classmethod
+    def active(cls):
+        """Query over beers that have not been deleted."""
+        return cls.query.filter(cls.deleted_at == None)
 
     @property
     def name(self):
@@ -100,10 +531,9 @@ class Beer(db.Model):
 
     @hybrid_property
     def average_rating(self):
-        count = self.ratings.count()
-        if count:
-            return sum([r.average for r in self.ratings]) / count
-        return 0
+        #the same avg() the listings select, so every endpoint reports the same value
+        average = db.session.query(func.avg(Rating.average)).filter(Rating.beer_id == self.id).scalar()
+        return float(average) if average is not None else 0
 
     @average_rating.expression
     def average_rating(cls):
@@ -116,10 +546,13 @@ class Beer(db.Model):
         'ibu' : self.ibu,
         'calories' : self.calories,
         'abv' : self.abv,
-        'brewery' : self.brewery,
+        'brewery' : self.brewery.brewery_name if self.brewery else None,
+        'brewery_slug': self.brewery.slug if self.brewery else None,
         'glass_name': self.glass.glass_name,
-        'average_rating': self.average_rating
         }
+
+        if include_rating:
+            d['average_rating'] = self.average_rating
         return d
 
 #Ratings Model
@@ -139,10 +572,10 @@ class Rating(db.Model):
 
     #beerId, userId foreign keys
 
-    user_id = db.Column(db.Integer, db.ForeignKey('Users.id'))
-    user = db.relationship('User', foreign_keys=[user_id], backref=db.backref('ratings', lazy='dynamic', viewonly=True, cascade='all, delete'))
-    beer_id = db.Column(db.Integer, db.ForeignKey('Beers.id'))
-    beer = db.relationship('Beer', foreign_keys=[beer_id], backref=db.backref('ratings', lazy='dynamic', viewonly=True, cascade='all, delete'))
+    user_id = db.Column(db.Integer, db.ForeignKey('Users.id', ondelete='CASCADE'), index=True)
+    user = db.relationship('User', foreign_keys=[user_id], backref=db.backref('ratings', lazy='dynamic', viewonly=True, passive_deletes=True))
+    beer_id = db.Column(db.Integer, db.ForeignKey('Beers.id', ondelete='CASCADE'), index=True)
+    beer = db.relationship('Beer', foreign_keys=[beer_id], backref=db.backref('ratings', lazy='dynamic', viewonly=True, passive_deletes=True))
 
     @hybrid_property                      
     def average(self):
@@ -168,12 +601,782 @@ class Rating(db.Model):
             d['user'] = self.user.username
         return d
 
+#Taste profile model
+
+
+RATING_DIMENSIONS = ('aroma', 'appearance', 'taste', 'palate', 'bottle')
+
+#the parts of a beer a taste profile is built from
+BeerTraits = namedtuple('BeerTraits', ['abv', 'ibu', 'brewery'])
+
+
+class TasteProfile(db.Model):
+    """Per-user rating aggregates, maintained incrementally on every rating write.
+
+    Only running sums are stored so a rating can be retracted as cheaply as it
+    was added; means and abv/ibu ranges (mean +/- one standard deviation) are
+    derived from them when serialized.
+    """
+    __tablename__ = 'TasteProfiles'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('Users.id', ondelete='CASCADE'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    aroma_sum = db.Column(db.Integer, nullable=False, default=0)
+    appearance_sum = db.Column(db.Integer, nullable=False, default=0)
+    taste_sum = db.Column(db.Integer, nullable=False, default=0)
+    palate_sum = db.Column(db.Integer, nullable=False, default=0)
+    bottle_sum = db.Column(db.Integer, nullable=False, default=0)
+    abv_sum = db.Column(db.Float, nullable=False, default=0)
+    abv_sq_sum = db.Column(db.Float, nullable=False, default=0)
+    ibu_sum = db.Column(db.Float, nullable=False, default=0)
+    ibu_sq_sum = db.Column(db.Float, nullable=False, default=0)
+    #json object of brewery name -> [rating count, sum of rating averages]
+    _breweries = db.Column('breweries', db.Text, nullable=False, default='{}')
+
+    @classmethod
+    def empty(cls, user_id):
+        profile = cls(user_id=user_id, rating_count=0, abv_sum=0, abv_sq_sum=0, ibu_sum=0, ibu_sq_sum=0, _breweries='{}')
+        for dim in RATING_DIMENSIONS:
+            setattr(profile, dim + '_sum', 0)
+        return profile
+
+    @classmethod
+    def for_user_id(cls, user_id):
+        """Returns the user's profile locked for update, creating it if needed.
+
+        A missing profile is created with INSERT ... ON CONFLICT DO NOTHING, since
+        FOR UPDATE locks nothing while the row does not exist and two first
+        ratings would otherwise both insert it.
+        """
+        profile = cls.query.with_for_update().filter_by(user_id=user_id).first()
+        if profile is None:
+            columns = ['rating_count'] + [dim + '_sum' for dim in RATING_DIMENSIONS] + ['abv_sum', 'abv_sq_sum', 'ibu_sum', 'ibu_sq_sum']
+            db.session.execute('INSERT INTO "TasteProfiles" (user_id, breweries, %s) VALUES (:user_id, \'{}\', %s) ON CONFLICT (user_id) DO NOTHING'
+                               % (', '.join(columns), ', '.join('0' for _ in columns)), {'user_id': user_id})
+            profile = cls.query.with_for_update().filter_by(user_id=user_id).one()
+        return profile
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Recomputes every profile from the ratings table.
+
+        The sums are one grouped INSERT ... SELECT; the brewery blobs are built
+        from per (user, brewery) totals, so no rating is loaded as an object.
+        """
+        cls.query.delete()
+        rated = Rating.__table__.join(Beer.__table__, Rating.beer_id == Beer.id)
+        abv = func.coalesce(Beer.abv, 0)
+        ibu = func.coalesce(Beer.ibu, 0)
+
+        columns = ['user_id', 'rating_count'] + [dim + '_sum' for dim in RATING_DIMENSIONS] + ['abv_sum', 'abv_sq_sum', 'ibu_sum', 'ibu_sq_sum', 'breweries']
+        sums = [Rating.user_id, func.count(Rating.id)] + [func.sum(getattr(Rating, dim)) for dim in RATING_DIMENSIONS]
+        sums += [func.sum(abv), func.sum(abv * abv), func.sum(ibu), func.sum(ibu * ibu), literal('{}')]
+        db.session.execute(cls.__table__.insert().from_select(columns, select(sums).select_from(rated).group_by(Rating.user_id)))
+
+        totals = select([Rating.user_id, Brewery._name, func.count(Rating.id), func.sum(Rating.average)])
+        totals = totals.select_from(rated.join(Brewery.__table__, Beer.brewery_id == Brewery.id))
+        totals = totals.group_by(Rating.user_id, Brewery._name).order_by(Rating.user_id)
+        update = cls.__table__.update().where(cls.user_id == bindparam('profile_id')).values(breweries=bindparam('profile_breweries'))
+
+        batch = []
+        for user_id, rows in groupby(db.session.execute(totals), lambda row: row[0]):
+            breweries = dict((name, [count, total]) for _, name, count, total in rows)
+            batch.append({'profile_id': user_id, 'profile_breweries': json.dumps(breweries)})
+            if len(batch) == batch_size:
+                db.session.execute(update, batch)
+                batch = []
+        if batch:
+            db.session.execute(update, batch)
+
+    @classmethod
+    def move_beer(cls, beer, before):
+        """Re-applies every rating of beer whose traits changed from before (a BeerTraits)."""
+        ratings = beer.ratings.all()
+        user_ids = set(rating.user_id for rating in ratings)
+        profiles = {}
+        if user_ids:
+            profiles = dict((p.user_id, p) for p in cls.query.with_for_update().filter(cls.user_id.in_(user_ids)))
+        for rating in ratings:
+            profile = profiles.get(rating.user_id)
+            if profile is None:
+                profile = profiles[rating.user_id] = cls.for_user_id(rating.user_id)
+            profile.apply(rating, before, -1)
+            profile.apply(rating, beer)
+
+    def apply(self, rating, beer, sign=1):
+        """Adds (sign=1) or retracts (sign=-1) a rating of beer."""
+        self.rating_count += sign
+        for dim in RATING_DIMENSIONS:
+            setattr(self, dim + '_sum', getattr(self, dim + '_sum') + sign * getattr(rating, dim))
+
+        abv = beer.abv or 0
+        ibu = beer.ibu or 0
+        self.abv_sum += sign * abv
+        self.abv_sq_sum += sign * abv * abv
+        self.ibu_sum += sign * ibu
+        self.ibu_sq_sum += sign * ibu * ibu
+
+        if beer.brewery is not None:
+            name = beer.brewery.brewery_name
+            breweries = json.loads(self._breweries)
+            count, total = breweries.get(name, (0, 0))
+            count += sign
+            total += sign * rating.average
+            if count > 0:
+                breweries[name] = [count, total]
+            else:
+                breweries.pop(name, None)
+            self._breweries = json.dumps(breweries)
+
+    def _range(self, total, sq_total):
+        mean = float(total) / self.rating_count
+        spread = math.sqrt(max(float(sq_total) / self.rating_count - mean * mean, 0))
+        return [round(mean - spread, 2), round(mean + spread, 2)]
+
+    def to_dict(self, favorite_breweries=3):
+        d = {
+        'rating_count': self.rating_count,
+        'means': dict((dim, None) for dim in RATING_DIMENSIONS),
+        'abv_range': None,
+        'ibu_range': None,
+        'favorite_breweries': []
+        }
+
+        if self.rating_count > 0:
+            for dim in RATING_DIMENSIONS:
+                d['means'][dim] = round(float(getattr(self, dim + '_sum')) / self.rating_count, 2)
+            d['abv_range'] = self._range(self.abv_sum, self.abv_sq_sum)
+            d['ibu_range'] = self._range(self.ibu_sum, self.ibu_sq_sum)
+
+            breweries = json.loads(self._breweries)
+            ranked = sorted(breweries.items(), key=lambda item: (float(item[1][1]) / item[1][0], item[1][0]), reverse=True)
+            d['favorite_breweries'] = [{
+                'brewery': name,
+                'rating_count': count,
+                'average_rating': round(float(total) / count, 2)
+            } for name, (count, total) in ranked[:favorite_breweries]]
+        return d
+
+
+#Rating rollup model
+
+
+class RatingRollup(db.Model):
+    """Hourly rating counts per beer, so recent activity never needs a scan of Ratings.
+
+    Rows older than any trending window can be archived with a range delete
+    on the bucket index.
+    """
+    __tablename__ = 'RatingRollups'
+
+    beer_id = db.Column(db.Integer, db.ForeignKey('Beers.id', ondelete='CASCADE'), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True, index=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    average_sum = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def bucket_for(moment):
+        return moment.replace(minute=0, second=0, microsecond=0)
+
+    #one statement whether or not the hour's row exists yet, so concurrent first ratings cannot both insert it
+    _upsert = db.text('INSERT INTO "RatingRollups" (beer_id, bucket, "count", average_sum) VALUES (:beer_id, :bucket, :count, :average_sum) '
+                      'ON CONFLICT (beer_id, bucket) DO UPDATE SET "count" = "RatingRollups"."count" + excluded."count", '
+                      'average_sum = "RatingRollups".average_sum + excluded.average_sum').bindparams(bindparam('bucket', type_=db.DateTime))
+
+    @classmethod
+    def apply(cls, rating, beer, sign=1):
+        """Adds (sign=1) or retracts (sign=-1) a rating of beer from its hour's rollup."""
+        db.session.execute(cls._upsert, {'beer_id': beer.id, 'bucket': cls.bucket_for(rating.created_at),
+                                         'count': sign, 'average_sum': sign * rating.average})
+
+    @staticmethod
+    def bucket_expression(column):
+        """bucket_for as SQL."""
+        if db.engine.dialect.name == 'postgresql':
+            #a literal rather than a parameter, so GROUP BY sees the same expression as SELECT
+            return func.date_trunc(literal_column("'hour'"), column)
+        #sqlite keeps datetimes as text in this format
+        return func.strftime('%Y-%m-%d %H:00:00.000000', column)
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes every rollup from the ratings table with one grouped INSERT ... SELECT."""
+        cls.query.delete()
+        bucket = cls.bucket_expression(Rating.created_at)
+        rolled = select([Rating.beer_id, bucket, func.count(Rating.id), func.sum(Rating.average)]).group_by(Rating.beer_id, bucket)
+        db.session.execute(cls.__table__.insert().from_select(['beer_id', 'bucket', 'count', 'average_sum'], rolled))
+
+
+TRENDING_WINDOWS = {
+    '24h': datetime.timedelta(hours=24),
+    '7d': datetime.timedelta(days=7),
+    '30d': datetime.timedelta(days=30)
+}
+
+class TrendingCounters(object):
+    """Per-window {beer id: [rating count, sum of averages]} held in memory.
+
+    Each window is summed from the rollups at most every TRENDING_REFRESH
+    seconds; in between, this process's own rating writes bump the counters
+    in place. Writes made by other workers, or rolled back after being
+    counted, show up or drop out at the next refresh.
+    """
+
+    def __init__(self):
+        self._windows = {}      #window -> (loaded at, window start, counters)
+        self._lock = threading.Lock()
+
+    def get(self, window):
+        now = datetime.datetime.now()
+        entry = self._windows.get(window)
+        if entry is None or (now - entry[0]).total_seconds() > app.config['TRENDING_REFRESH']:
+            start = RatingRollup.bucket_for(now - TRENDING_WINDOWS[window])
+            query = db.session.query(RatingRollup.beer_id, func.sum(RatingRollup.count), func.sum(RatingRollup.average_sum))
+            query = query.filter(RatingRollup.bucket >= start)
+            query = query.group_by(RatingRollup.beer_id)
+            entry = (now, start, dict((beer_id, [int(count), int(total)]) for beer_id, count, total in query))
+            with self._lock:
+                self._windows[window] = entry
+        return entry[2]
+
+    def apply(self, rating, beer, sign=1):
+        self.bump(beer.id, rating.created_at, sign, sign * rating.average)
+
+    def bump(self, beer_id, moment, count, total):
+        """Adds count ratings summing to total, made at moment, to beer_id's counters."""
+        with self._lock:
+            for loaded_at, start, counters in self._windows.values():
+                if moment >= start:
+                    counter = counters.setdefault(beer_id, [0, 0])
+                    counter[0] += count
+                    counter[1] += total
+
+trending = TrendingCounters()
+
+#Change log model
+
+
+class Change(db.Model):
+    """Append-only log of writes, added in the same transaction as the write it records."""
+    __tablename__ = 'Changes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    op = db.Column(db.String(16), nullable=False)
+    key = db.Column(db.String(512), nullable=False)
+    payload = db.Column(db.Text)
+    #set in python rather than by the database, so it is comparable with the clock the feed reads
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now, index=True)
+
+    @staticmethod
+    def row_to_dict(row):
+        return {
+        'id': row.id,
+        'kind': row.kind,
+        'op': row.op,
+        'key': row.key,
+        'data': json.loads(row.payload) if row.payload else None,
+        'created_at': row.created_at.isoformat()
+        }
+
+
+def record_change(kind, op, key, data=None):
+    """Adds a change log entry to the current transaction."""
+    db.session.add(Change(kind=kind, op=op, key=key, payload=json.dumps(data) if data is not None else None))
+
+
+def track_rating(rating, user_id, beer, sign=1):
+    """Applies (sign=1) or retracts (sign=-1) a rating against the precomputed aggregates."""
+    TasteProfile.for_user_id(user_id).apply(rating, beer, sign)
+    RatingRollup.apply(rating, beer, sign)
+    trending.apply(rating, beer, sign)
+    if beer.brewery_id is not None:
+        Brewery.for_id(beer.brewery_id).apply(rating, sign)
+
 #-------------------------------------------------------------Models end here---------------------------------------------#
+# purging
+#
+# DELETE on a user or beer only writes a tombstone (deleted_at), so the request
+# returns at once and reads stop seeing the row through the deleted_at index.
+# The purger thread then removes dependent ratings and favorites in batches of
+# PURGE_BATCH_SIZE, committing after each so no lock is held for long, and
+# finally the row itself.
+
+def _claim(model, row_id):
+    """Locks a tombstoned row until the next commit, so only one purger works on it at a time.
+
+    Returns False if the row is gone or another purger (another worker, or
+    manage.py purge) holds the lock; it is skipped rather than waited on.
+    """
+    try:
+        claimed = db.session.query(model.id).with_for_update(nowait=True).filter(model.id == row_id, model.deleted_at != None).first()
+    except OperationalError:
+        db.session.rollback()
+        return False
+    return claimed is not None
+
+def _retract_ratings(rows, beer=None):
+    """Retracts a batch of rating rows from the aggregates, with one update per
+    beer and hour, per brewery and, when purging a beer, per rater.
+
+    Each update subtracts in place, so unlike track_rating no row is read and
+    locked first. Purging a user skips their profile, which is deleted anyway.
+    """
+    rollups = {}
+    breweries = {}
+    for row in rows:
+        delta = rollups.setdefault((row.beer_id, RatingRollup.bucket_for(row.created_at)), [0, 0])
+        delta[0] += 1
+        delta[1] += row.average
+        if row.brewery_id is not None:
+            delta = breweries.setdefault(row.brewery_id, [0, 0])
+            delta[0] += 1
+            delta[1] += row.average
+
+    table = RatingRollup.__table__
+    update = table.update().where(table.c.beer_id == bindparam('rollup_beer')).where(table.c.bucket == bindparam('rollup_bucket'))
+    update = update.values(count=table.c.count - bindparam('rollup_count'), average_sum=table.c.average_sum - bindparam('rollup_sum'))
+    db.session.execute(update, [{'rollup_beer': beer_id, 'rollup_bucket': bucket, 'rollup_count': count, 'rollup_sum': total}
+                                for (beer_id, bucket), (count, total) in rollups.items()])
+
+    if breweries:
+        table = Brewery.__table__
+        update = table.update().where(table.c.id == bindparam('brewery_id'))
+        update = update.values(rating_count=table.c.rating_count - bindparam('brewery_count'), rating_sum=table.c.rating_sum - bindparam('brewery_sum'))
+        db.session.execute(update, [{'brewery_id': brewery_id, 'brewery_count': count, 'brewery_sum': total}
+                                    for brewery_id, (count, total) in breweries.items()])
+
+    if beer is not None:
+        profiles = TasteProfile.query.with_for_update().filter(TasteProfile.user_id.in_(set(row.user_id for row in rows)))
+        profiles = dict((profile.user_id, profile) for profile in profiles)
+        for row in rows:
+            if row.user_id in profiles:
+                profiles[row.user_id].apply(row, beer, -1)
+
+    for (beer_id, bucket), (count, total) in rollups.items():
+        trending.bump(beer_id, bucket, -count, -total)
+
+def _purge_ratings(model, row_id, criterion, batch_size):
+    """Retracts and deletes ratings in batches, each under the tombstone's lock.
+
+    Returns True with the lock still held once none are left, False if the
+    tombstone could not be claimed.
+    """
+    columns = [Rating.id, Rating.user_id, Rating.beer_id, Rating.created_at, Rating.average.label('average'), Beer.brewery_id, Beer.slug]
+    columns += [getattr(Rating, dim) for dim in RATING_DIMENSIONS]
+    batch = select(columns).select_from(Rating.__table__.join(Beer.__table__, Rating.beer_id == Beer.id)).where(criterion).limit(batch_size)
+    while True:
+        if not _claim(model, row_id):
+            return False
+        rows = db.session.execute(batch).fetchall()
+        if not rows:
+            return True
+        _retract_ratings(rows, Beer.query.get(row_id) if model is Beer else None)
+        Rating.query.filter(Rating.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        response_cache.invalidate('Ratings', 'Breweries', *set('Ratings:' + row.slug for row in rows))
+
+def _purge_favorites(column, value, batch_size):
+    other = favorites.c.beer_id if column is favorites.c.user_id else favorites.c.user_id
+    while True:
+        batch = select([other]).where(column == value).limit(batch_size)
+        result = db.session.execute(favorites.delete().where(column == value).where(other.in_(batch)))
+        db.session.commit()
+        if result.rowcount < batch_size:
+            return
+
+def purge_tombstones(batch_size=None):
+    """Removes tombstoned users and beers along with their ratings and favorites.
+
+    Safe to run from several processes at once: ratings are only retracted
+    under the tombstone's lock, and the deletes that follow are idempotent.
+    """
+    batch_size = batch_size or app.config['PURGE_BATCH_SIZE']
+
+    for user_id, in db.session.query(User.id).filter(User.deleted_at != None).all():
+        if not _purge_ratings(User, user_id, Rating.user_id == user_id, batch_size):
+            continue
+        _purge_favorites(favorites.c.user_id, user_id, batch_size)
+        TasteProfile.query.filter_by(user_id=user_id).delete()
+        Beer.query.filter_by(created_by_id=user_id).update({'created_by_id': None})
+        User.query.filter_by(id=user_id).delete()
+        db.session.commit()
+
+    for beer_id, in db.session.query(Beer.id).filter(Beer.deleted_at != None).all():
+        if not _purge_ratings(Beer, beer_id, Rating.beer_id == beer_id, batch_size):
+            continue
+        _purge_favorites(favorites.c.beer_id, beer_id, batch_size)
+        Beer.query.filter_by(id=beer_id).delete()
+        db.session.commit()
+
+class Purger(object):
+    """Runs purge_tombstones on a daemon thread, every PURGE_INTERVAL seconds or when woken."""
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='purger')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(app.config['PURGE_INTERVAL'])
+            self._wake.clear()
+            try:
+                with app.app_context():
+                    purge_tombstones()
+            except Exception:
+                app.logger.exception('purging tombstones failed')
+
+purger = Purger()
+
+@app.before_first_request
+def start_purger():
+    #picks up tombstones left behind by a previous run
+    purger.wake()
+
+# change feed
+#
+# One poller thread per process reads new Changes rows into a bounded
+# in-memory tail and wakes every subscriber; subscribers only wait on a
+# condition, so an idle one costs no database work. It still holds its
+# worker: under sync or threaded workers (including manage.py runserver)
+# every open stream or long poll ties up one OS thread until it ends, so
+# serving many idle subscribers needs a gevent or eventlet worker, e.g.
+# gunicorn -k gevent beer:app. CHANGE_FEED_MAX_SUBSCRIBERS caps them per
+# process so idle streams cannot take every thread; raise it under gevent.
+
+def read_changes(after, limit=500):
+    """Returns committed changes with ids after the cursor, oldest first.
+
+    Ids come from a sequence, so a transaction can commit after one that took
+    a later id. A gap is therefore only skipped once the row after it is older
+    than CHANGE_FEED_SETTLE; until then the read stops short of it.
+    """
+    table = Change.__table__
+    query = table.select().where(table.c.id > after).order_by(table.c.id).limit(limit)
+    settled = datetime.datetime.now() - datetime.timedelta(seconds=app.config['CHANGE_FEED_SETTLE'])
+
+    changes = []
+    with db.engine.connect() as connection:
+        for row in connection.execute(query):
+            if row.id != after + 1 and row.created_at > settled:
+                break
+            changes.append(Change.row_to_dict(row))
+            after = row.id
+    return changes
+
+class ChangeFeed(object):
+    """Fans the change log out to every subscriber of this process from one shared poller."""
+
+    def __init__(self):
+        self._tail = deque(maxlen=app.config['CHANGE_FEED_TAIL'])
+        self._cond = threading.Condition()
+        self._last_id = None
+        self._thread = None
+        self._subscribers = 0
+
+    def _start(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                if self._last_id is None:
+                    self._last_id = db.session.query(func.max(Change.id)).scalar() or 0
+                self._thread = threading.Thread(target=self._run, name='change-feed')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['CHANGE_FEED_POLL'])
+            try:
+                with app.app_context():
+                    changes = read_changes(self._last_id)
+            except Exception:
+                app.logger.exception('reading the change log failed')
+                continue
+
+            if changes:
+                with self._cond:
+                    self._tail.extend(changes)
+                    self._last_id = changes[-1]['id']
+                    self._cond.notify_all()
+
+    def subscribe(self):
+        """Counts an open /changes request; False once CHANGE_FEED_MAX_SUBSCRIBERS are open."""
+        with self._cond:
+            if self._subscribers >= app.config['CHANGE_FEED_MAX_SUBSCRIBERS']:
+                return False
+            self._subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def read(self, cursor, timeout):
+        """Returns changes after cursor, waiting up to timeout seconds for one to arrive."""
+        self._start()
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                oldest = self._tail[0]['id'] if self._tail else self._last_id + 1
+                if cursor + 1 < oldest:
+                    break
+
+                changes = []
+                for change in reversed(self._tail):
+                    if change['id'] <= cursor:
+                        break
+                    changes.append(change)
+                if changes:
+                    changes.reverse()
+                    return changes
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+
+        #further back than the tail reaches, so catch up from the table
+        changes = read_changes(cursor)
+        if not changes:
+            #only a gap that has not settled yet lies ahead; don't spin on it
+            time.sleep(min(app.config['CHANGE_FEED_POLL'], max(deadline - time.time(), 0)))
+        return changes
+
+change_feed = ChangeFeed()
+
+# multi-get
+
+class SingleFlight(object):
+    """Lets concurrent callers asking for the same key share one computation.
+
+    Results are handed to every waiting thread, so they must not be tied to
+    the leader's session; callers pass functions that return plain dicts.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+lookups = SingleFlight()
+
+def batch_lookup(kind, param, fetch):
+    """Serves ?<param>=a,b,c with one fetch(keys) call returning {key: dict}.
+
+    The response maps every requested key to its dict, or null when it was
+    not found, and lists the misses under 'missing'.
+    """
+    keys = list(OrderedDict.fromkeys(k for k in request.args[param].split(',') if k))
+    if len(keys) > app.config['BATCH_MAX_KEYS']:
+        return jsonify({'error': 'at most %d %s per request' % (app.config['BATCH_MAX_KEYS'], param)}), 422
+
+    found = lookups.do((kind,) + tuple(sorted(keys)), lambda: fetch(keys))
+    return jsonify({kind: dict((k, found.get(k)) for k in keys), 'missing': [k for k in keys if k not in found]})
+
+# response cache
+#
+# Listing views are cached as serialized bytes, keyed on endpoint, view
+# arguments and sorted query arguments. A cached view names the tags it reads:
+# a table ('Ratings') or one slice of it ('Ratings:<slug>'). Write handlers
+# name the tags they touch and, once they succeed, every entry built from one
+# of those tags is dropped. Invalidation is per process; entries also expire
+# after RESPONSE_CACHE_TTL so writes seen by other workers arrive eventually.
+
+class ResponseCache(object):
+    """Serialized responses, bounded by total bytes with LRU eviction and invalidated by tag."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   #key -> entry dict
+        self._by_tag = {}               #tag -> keys of entries built from it
+        self._versions = {}             #tag -> times invalidated
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry['expires'] < time.time():
+                self._entries[key] = entry
+                self._drop(key)
+                return None
+            self._entries[key] = entry
+            return entry
+
+    def versions(self, tags):
+        with self._lock:
+            return [self._versions.get(tag, 0) for tag in tags]
+
+    def put(self, key, entry, tags, versions):
+        """Stores entry unless one of its tags was invalidated since versions was read."""
+        size = len(entry['body']) + len(entry['gzipped'] or '')
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if versions != [self._versions.get(tag, 0) for tag in tags]:
+                return
+            self._drop(key)
+            entry['size'] = size
+            entry['tags'] = tags
+            self._entries[key] = entry
+            self._size += size
+            for tag in tags:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+                for key in list(self._by_tag.get(tag, ())):
+                    self._drop(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry['size']
+        for tag in entry['tags']:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_BYTES'])
+
+def _gzip(body):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+        out.write(body)
+    return buf.getvalue()
+
+def _render(view, args, kwargs, key, tags):
+    versions = response_cache.versions(tags)
+    response = app.make_response(view(*args, **kwargs))
+    body = response.get_data()
+    entry = {
+        'body': body,
+        'gzipped': _gzip(body) if len(body) >= app.config['RESPONSE_CACHE_GZIP_MIN'] else None,
+        'status': response.status_code,
+        'mimetype': response.mimetype,
+        'expires': time.time() + app.config['RESPONSE_CACHE_TTL']
+    }
+    if response.status_code == 200:
+        response_cache.put(key, entry, tags, versions)
+    return entry
+
+def cached(*tags):
+    """Caches a GET view. tags name what it reads; '{arg}' is filled in from the view arguments."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            deps = [tag.format(**kwargs) for tag in tags]
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))))
+
+            entry = response_cache.get(key)
+            if entry is None:
+                #concurrent misses on one key share a single render
+                entry = lookups.do(('response',) + key, lambda: _render(view, args, kwargs, key, deps))
+
+            if entry['gzipped'] is not None and 'gzip' in request.accept_encodings:
+                response = Response(entry['gzipped'], entry['status'], mimetype=entry['mimetype'])
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response = Response(entry['body'], entry['status'], mimetype=entry['mimetype'])
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+        return wrapper
+    return decorator
+
+def touch(*tags):
+    """Adds tags to those the current write handler invalidates when it succeeds."""
+    g.setdefault('touched', set()).update(tags)
+
+def touches(*tags):
+    """Declares the tags a write view touches; '{arg}' is filled in from the view arguments."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            touch(*[tag.format(**kwargs) for tag in tags])
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code < 400:
+                response_cache.invalidate(*g.touched)
+            return response
+        return wrapper
+    return decorator
+
+def fetch_users(usernames):
+    return dict((u.username, u.to_dict()) for u in User.active().filter(User.username.in_(usernames)))
+
+def fetch_beers(slugs):
+    query = db.session.query(Beer, Beer.average_rating)
+    query = query.options(joinedload(Beer.glass), joinedload(Beer.brewery))
+    query = query.filter(Beer.slug.in_(slugs), Beer.deleted_at == None)
+
+    beers = {}
+    for beer, average in query:
+        d = beer.to_dict(include_rating=False)
+        d['average_rating'] = float(average) if average is not None else 0
+        beers[beer.slug] = d
+    return beers
+
+def fetch_ratings(pairs):
+    wanted = [tuple(pair.split(':', 1)) for pair in pairs if ':' in pair]
+    if not wanted:
+        return {}
+
+    query = Rating.query
+    query = query.join(Rating.user)
+    query = query.join(Rating.beer)
+    query = query.options(contains_eager(Rating.user), contains_eager(Rating.beer))
+    query = query.filter(tuple_(User.username, Beer.slug).in_(wanted))
+    query = query.filter(User.deleted_at == None, Beer.deleted_at == None)
+    return dict(('%s:%s' % (r.user.username, r.beer.slug), r.to_dict(include_beer=True, include_user=True)) for r in query)
+
 # users views
 
 @app.route('/users')
 def list_users():
-    
+    """Returns a list of users, or with ?usernames=a,b,c those users keyed by username."""
+    if 'usernames' in request.args:
+        return batch_lookup('users', 'usernames', fetch_users)
+
     user_sort_fields = {
         'username': User.username,
         '-username': User.username.desc(),
@@ -187,7 +1390,7 @@ def list_users():
     except KeyError:
         sort_field = user_sort_fields['username']
 
-    users = User.query
+    users = User.active()
     users = users.order_by(sort_field)
     users = users.all()
 
@@ -197,7 +1400,7 @@ def list_users():
 def get_user(username):
     """Retrieves a particular user by username."""
     try:
-        user = User.query.filter_by(username=username).one()  
+        user = User.active().filter_by(username=username).one()  
         return jsonify(user.to_dict())
     except NoResultFound:
         abort(404)
@@ -231,9 +1434,10 @@ def create_user():
         return jsonify({'error': 'bad or missing username'})
 
     try:
-        user.password = str(data['password'])
-        if user.password == '':
+        password = str(data['password'])
+        if password == '':
             return jsonify({'error': 'password is empty'})
+        user.password = password
     except KeyError, ValueError:
         return jsonify({'error': 'bad or missing password'})
 
@@ -246,11 +1450,16 @@ def create_user():
 
 #edit user details 
 @app.route('/users/<string:username>', methods=['PUT'])
+@login_required
+@touches()
 def edit_user(username):
     try:
-        user = User.query.filter_by(username=username).one()
+        user = User.active().filter_by(username=username).one()
     except NoResultFound:
         abort(404)
+
+    if user.id != g.user_id:
+        abort(403)
     
     data = request.get_json(force=True)
 
@@ -271,13 +1480,18 @@ def edit_user(username):
             return jsonify({'error': 'username is empty'})
         if slugify(user.username) != user.username:
             return jsonify({'error': 'username contained invalid characters'})
+        touch('Users')
     except ValueError:
         return jsonify({'error': 'bad username'})
     except KeyError:
         pass
 
     try:
-        user.password = str(data['password'])
+        password = str(data['password'])
+        if password == '':
+            return jsonify({'error': 'password is empty'})
+        user.password = password
+        token_cache.revoke_user(user.id)
     except ValueError:
         return jsonify({'error': 'bad password'})
     except KeyError:
@@ -287,22 +1501,65 @@ def edit_user(username):
     return jsonify(user.to_dict())
 
 
+@app.route('/login', methods=['POST'])
+def login():
+    """Checks a user's credentials. Requires username and password in input json."""
+    data = request.get_json(force=True)
+
+    try:
+        username = str(data['username'])
+        password = str(data['password'])
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': 'bad or missing username or password'}), 400
+
+    try:
+        user = User.active().filter_by(username=username).one()
+    except NoResultFound:
+        hash_password(password)     #keep the timing of unknown usernames in line with known ones
+        return jsonify({'error': 'invalid username or password'}), 401
+
+    if not user.check_password(password):
+        return jsonify({'error': 'invalid username or password'}), 401
+
+    db.session.commit()     #persists a transparently upgraded hash
+
+    token, claims = issue_token(user.id)
+    return jsonify({'username': user.username, 'token': token, 'expires': claims['exp']})
+
+@app.route('/logout', methods=['POST'])
+@login_required
+def logout():
+    """Revokes the bearer token the request was made with."""
+    token_cache.revoke(g.token)
+    return '', 204
+
 #delete user
 @app.route('/users/<string:username>', methods=['DELETE'])
+@login_required
+@touches('Users', 'Ratings')
 def delete_user(username):
     try:
-        user = User.query.filter_by(username=username).one()
+        user = User.active().filter_by(username=username).one()
     except NoResultFound:
         abort(404)
-    db.session.delete(user)
+
+    if user.id != g.user_id:
+        abort(403)
+
+    token_cache.revoke_user(user.id)
+    user.deleted_at = datetime.datetime.now()
+    record_change('user', 'delete', user.username)
     db.session.commit()
+    purger.wake()
     return '',204
 
 
 @app.route('/beers')
+@cached('Beers', 'Glasses', 'Ratings')
 def list_beers():
-    """Returns a list of beers."""
-    
+    """Returns a list of beers, or with ?slugs=a,b,c those beers keyed by slug."""
+    if 'slugs' in request.args:
+        return batch_lookup('beers', 'slugs', fetch_beers)
 
     beer_sort_fields = {
         'name': Beer._name,
@@ -311,8 +1568,8 @@ def list_beers():
         '-calories': Beer.calories.desc(),
         'abv': Beer.abv,
         '-abv': Beer.abv.desc(),
-        'brewery':Beer.brewery,
-        '-brewery': Beer.brewery.desc(),
+        'brewery': Brewery._name,
+        '-brewery': Brewery._name.desc(),
         'ibu' : Beer.ibu,
         '-ibu' : Beer.ibu.desc()
     }
@@ -323,41 +1580,72 @@ def list_beers():
     except KeyError:
         sort_field = beer_sort_fields['name']
 
-    beers = Beer.query 
+    beers = Beer.active()
+    beers = beers.outerjoin(Beer.brewery)
+    beers = beers.options(contains_eager(Beer.brewery))
     beers = beers.order_by(sort_field)
     beers = beers.all()
 
     return jsonify({'beers': [b.to_dict() for b in beers]})
 
+@app.route('/beers/trending')
+def trending_beers():
+    """Returns the beers rated most often, then best, within window (24h, 7d or 30d)."""
+    window = request.args.get('window', '24h')
+    if window not in TRENDING_WINDOWS:
+        return jsonify({'error': 'window must be one of 24h, 7d, 30d'}), 422
+
+    try:
+        limit = min(int(request.args.get('limit', 10)), 100)
+    except ValueError:
+        return jsonify({'error': 'bad format in limit'}), 422
+
+    counters = trending.get(window)
+    ranked = sorted([(count, float(total) / count, beer_id) for beer_id, (count, total) in counters.items() if count > 0], reverse=True)
+    ranked = ranked[:limit]
+    beers = dict((b.id, b) for b in Beer.active().filter(Beer.id.in_([beer_id for count, average, beer_id in ranked])))
+    hours = TRENDING_WINDOWS[window].total_seconds() / 3600
+
+    return jsonify({'window': window, 'beers': [{
+        'name': beers[beer_id].name,
+        'slug': beers[beer_id].slug,
+        'ratings': count,
+        'ratings_per_hour': round(count / hours, 3),
+        'recent_average': round(average, 2)
+    } for count, average, beer_id in ranked if beer_id in beers]})
+
 #get by name
 @app.route('/beers/<string:name>')
 def get_beer(name):
     """Returns a particular beer by name."""
     try:
-        beer = Beer.query.filter_by(slug=name).one()  
+        beer = Beer.active().filter_by(slug=name).one()  
         return jsonify(beer.to_dict())
     except NoResultFound:
         abort(404)
 
 #add a beer
 @app.route('/beers', methods=['POST'])
+@login_required
+@touches('Beers', 'Breweries')
 def create_beer():
     """Creates a new beer. Requires ibu, calories, abv, brewery, and glass type in input json."""
+    if token_user_deleted():
+        return jsonify({'error': 'missing or invalid token'}), 401
     data = request.get_json(force=True)
 
    
     beer = Beer()        
     db.session.add(beer)
 
-
     latest = Beer.query
-    latest = latest.join(Beer.created_by)
-    latest = latest.filter(User.username == data['username'])
+    latest = latest.filter(Beer.created_by_id == g.user_id)
     latest = latest.order_by(Beer.created_at.desc())
     latest = latest.first()
 
     if latest is not None and latest.created_at > datetime.datetime.now() - datetime.timedelta(days=1):
         return jsonify({'error': 'User already created beer today', 'beer': latest.to_dict()}), 422
+    beer.created_by_id = g.user_id
 
     try:
         glass = Glass.query.filter_by(slug=data['glass_name']).one()
@@ -390,10 +1678,17 @@ def create_beer():
         return jsonify({'error': 'bad format abv or missing values'})
 
     try:
-        beer.brewery = str(data['brewery'])
+        brewery_name = str(data['brewery'])
+        if brewery_slug(brewery_name) == '':
+            return jsonify({'error': 'brewery cannot be empty'})
     except (KeyError, ValueError) as e:
         return jsonify({'error': 'bad format brewery or missing values'})
 
+    beer.brewery = Brewery.for_name(brewery_name)
+    beer.brewery.beer_count += 1
+
+    record_change('beer', 'create', beer.slug, beer.to_dict(include_rating=False))
+
     try:
         db.session.commit()
     except IntegrityError:
@@ -407,13 +1702,16 @@ def create_beer():
 
 
 @app.route('/beers/<string:name>', methods=['PUT'])
+@login_required
+@touches('Beers', 'Beers:{name}', 'Breweries')
 def edit_beer(name):
     data = request.get_json(force=True)
     
     try:
-        beer = Beer.query.filter_by(slug=name).one()  
+        beer = Beer.active().filter_by(slug=name).one()  
     except NoResultFound:
         abort(404)
+    before = BeerTraits(beer.abv, beer.ibu, beer.brewery)
     
     try:
         glass = Glass.query.filter_by(slug=data['glass_name']).one()
@@ -454,32 +1752,111 @@ def edit_beer(name):
         pass
 
     try:
-        beer.brewery = str(data['brewery'])
+        brewery_name = str(data['brewery'])
+        if brewery_slug(brewery_name) == '':
+            return jsonify({'error': 'brewery cannot be empty'})
+
+        brewery = Brewery.for_name(brewery_name)
+        if brewery is not beer.brewery:
+            #the beer's ratings move with it
+            count, total = db.session.query(func.count(Rating.id), func.coalesce(func.sum(Rating.average), 0)).filter(Rating.beer_id == beer.id).one()
+            if beer.brewery_id is not None:
+                previous = Brewery.for_id(beer.brewery_id)
+                previous.beer_count -= 1
+                previous.rating_count -= count
+                previous.rating_sum -= total
+            brewery.beer_count += 1
+            brewery.rating_count += count
+            brewery.rating_sum += total
+            beer.brewery = brewery
     except ValueError:
         return jsonify({'error': 'bad format brewery'})
     except KeyError:
         pass
 
+    if BeerTraits(beer.abv, beer.ibu, beer.brewery) != before:
+        TasteProfile.move_beer(beer, before)
+
+    #keyed by the slug consumers knew the beer by; a rename carries the new slug in data
+    record_change('beer', 'update', name, beer.to_dict(include_rating=False))
     db.session.commit()
     return jsonify(beer.to_dict())
 
 #delete a beer from list of beers
 @app.route('/beers/<string:beer>', methods=['DELETE'])
+@login_required
+@touches('Beers', 'Beers:{beer}', 'Ratings', 'Breweries')
 def delete_beer(beer):
     try:
-        beer = Beer.query.filter_by(slug=beer).one()
+        beer = Beer.active().filter_by(slug=beer).one()
     except NoResultFound:
         abort(404)
 
-    db.session.delete(beer)
+    beer.deleted_at = datetime.datetime.now()
+    if beer.brewery_id is not None:
+        Brewery.for_id(beer.brewery_id).beer_count -= 1
+    record_change('beer', 'delete', beer.slug)
     db.session.commit()
+    purger.wake()
     return '',204
 
+#
+# /breweries views
+#
+@app.route('/breweries')
+@cached('Breweries')
+def list_breweries():
+    """Returns a list of breweries with their rolled-up statistics."""
+    brewery_sort_fields = {
+        'name': Brewery._name,
+        '-name': Brewery._name.desc(),
+        'beer_count': Brewery.beer_count,
+        '-beer_count': Brewery.beer_count.desc(),
+        'rating_count': Brewery.rating_count,
+        '-rating_count': Brewery.rating_count.desc()
+    }
+
+    try:
+        sort_param = request.args.get('sort', None)
+        sort_field = brewery_sort_fields.get(sort_param)
+    except KeyError:
+        sort_field = brewery_sort_fields['name']
+
+    breweries = Brewery.query
+    breweries = breweries.filter(Brewery.beer_count > 0)
+    breweries = breweries.order_by(sort_field)
+    breweries = breweries.all()
+
+    return jsonify({'breweries': [b.to_dict() for b in breweries]})
+
+@app.route('/breweries/<string:slug>/beers')
+@cached('Breweries', 'Beers', 'Glasses', 'Ratings')
+def get_brewery_beers(slug):
+    """Returns a particular brewery (by slug) with its beers."""
+    try:
+        brewery = Brewery.query.filter_by(slug=slug).one()
+    except NoResultFound:
+        abort(404)
+
+    query = db.session.query(Beer, Beer.average_rating)
+    query = query.options(joinedload(Beer.glass))
+    query = query.filter(Beer.brewery_id == brewery.id, Beer.deleted_at == None)
+    query = query.order_by(Beer._name)
+
+    beers = []
+    for beer, average in query:
+        d = beer.to_dict(include_rating=False)
+        d['average_rating'] = float(average) if average is not None else 0
+        beers.append(d)
+
+    return jsonify({'brewery': brewery.to_dict(), 'beers': beers})
+
 #
 # /glasses views
 #
 #get all glass
 @app.route('/glasses')
+@cached('Glasses')
 def list_glasses():
     """Retrieves a list of glass names."""
     return jsonify({'glasses': [g.to_dict() for g in Glass.query.all()]})
@@ -488,6 +1865,8 @@ def list_glasses():
 
 #add a glass
 @app.route('/glasses', methods=['POST'])
+@login_required
+@touches('Glasses')
 def create_glass():
     """Creates a new glass type. Requires name in input json."""
     data = request.get_json(force=True)
@@ -508,6 +1887,8 @@ def create_glass():
 
 # update glass
 @app.route('/glasses/<string:glass_name>', methods=['PUT'])
+@login_required
+@touches('Glasses')
 def edit_glass(glass_name):
     try:
         glass = Glass.query.filter_by(slug=glass_name).one()
@@ -531,6 +1912,8 @@ def edit_glass(glass_name):
 
 #delete a particular glass
 @app.route('/glasses/<string:glass_name>', methods=['DELETE'])
+@login_required
+@touches('Glasses')
 def delete_glass(glass_name):
     try:
         glass = Glass.query.filter_by(slug=glass_name).one()
@@ -550,7 +1933,12 @@ def delete_glass(glass_name):
 # /ratings views 
 #
 @app.route('/ratings')
+@cached('Ratings', 'Users', 'Beers')
 def get_ratings():
+    """Returns a list of ratings, or with ?pairs=user:beer,... those ratings keyed by pair."""
+    if 'pairs' in request.args:
+        return batch_lookup('ratings', 'pairs', fetch_ratings)
+
     ratings_sort_fields = {
         'aroma': Rating.aroma,
         '-aroma': Rating.aroma.desc(),
@@ -573,6 +1961,9 @@ def get_ratings():
         sort_field = ratings_sort_fields['average']
 
     ratings = Rating.query 
+    ratings = ratings.join(Rating.user)
+    ratings = ratings.join(Rating.beer)
+    ratings = ratings.filter(User.deleted_at == None, Beer.deleted_at == None)
     ratings = ratings.order_by(sort_field)
     ratings = ratings.all()
 
@@ -583,7 +1974,7 @@ def get_user_ratings(username):
     """Returns a list of ratings created by a particular user (by username)."""
     
     try:
-        user = User.query.filter_by(username=username).one()
+        user = User.active().filter_by(username=username).one()
     except NoResultFound:
         abort(404)
 
@@ -610,11 +2001,29 @@ def get_user_ratings(username):
         sort_field = ratings_sort_fields['average']
 
     ratings = user.ratings
+    ratings = ratings.join(Rating.beer)
+    ratings = ratings.filter(Beer.deleted_at == None)
     ratings = ratings.order_by(sort_field)
     ratings = ratings.all()
     
     return jsonify({'ratings': [r.to_dict(include_beer=True) for r in ratings]})  
 
+@app.route('/users/<string:username>/profile')
+def get_user_profile(username):
+    """Returns the precomputed taste profile of a particular user (by username)."""
+    query = db.session.query(User.id, TasteProfile)
+    query = query.outerjoin(TasteProfile, TasteProfile.user_id == User.id)
+    query = query.filter(User.username == username, User.deleted_at == None)
+
+    try:
+        user_id, profile = query.one()
+    except NoResultFound:
+        abort(404)
+
+    if profile is None:
+        profile = TasteProfile.empty(user_id)
+    return jsonify({'profile': profile.to_dict()})
+
 @app.route('/users/<string:username>/ratings/<string:beer>')
 def get_user_rating_for_beer(username, beer):
     """Returns a rating created by a particular usre (by username) about a particular beer (by name)."""
@@ -623,6 +2032,7 @@ def get_user_rating_for_beer(username, beer):
         query = query.join(Rating.user)
         query = query.join(Rating.beer)
         query = query.filter(User.username == username, Beer.slug == beer)
+        query = query.filter(User.deleted_at == None, Beer.deleted_at == None)
 
         rating = query.one()
         return jsonify({'rating': rating.to_dict(include_beer=True, include_user=True)})  
@@ -631,6 +2041,8 @@ def get_user_rating_for_beer(username, beer):
 
 
 @app.route('/users/<string:username>/ratings/<string:beer>', methods=['PUT'])
+@login_required
+@touches('Ratings', 'Ratings:{beer}', 'Breweries')
 def update_user_rating_for_beer(username, beer):
     """Creates a rating created by a particular user (by username) about a particular beer (by name)."""
     try:
@@ -638,12 +2050,18 @@ def update_user_rating_for_beer(username, beer):
         query = query.join(Rating.user)
         query = query.join(Rating.beer)
         query = query.filter(User.username == username, Beer.slug == beer)
+        query = query.filter(User.deleted_at == None, Beer.deleted_at == None)
 
         rating = query.one()
     except NoResultFound:
         abort(404)
 
+    if rating.user_id != g.user_id:
+        abort(403)
+
     data = request.get_json(force=True)  
+    #retracted only once the new values validate; trending's in-memory counters are not rolled back
+    before = Rating(created_at=rating.created_at, **dict((dim, getattr(rating, dim)) for dim in RATING_DIMENSIONS))
 
     try:
         rating.aroma = int(data['aroma'])
@@ -694,9 +2112,15 @@ def update_user_rating_for_beer(username, beer):
     except KeyError:
         pass
 
+    track_rating(before, rating.user_id, rating.beer, -1)
+    track_rating(rating, rating.user_id, rating.beer)
+    record_change('rating', 'update', '%s:%s' % (username, beer), rating.to_dict())
+    db.session.commit()
     return jsonify({'rating': rating.to_dict(include_beer=True, include_user=True)})  
 
 @app.route('/users/<string:username>/ratings/<string:beer>', methods=['DELETE'])
+@login_required
+@touches('Ratings', 'Ratings:{beer}', 'Breweries')
 def delete_user_rating_for_beer(username, beer):
     """deletes a rating created by a particular usre (by username) about a particular beer (by name)."""
     try:
@@ -704,22 +2128,28 @@ def delete_user_rating_for_beer(username, beer):
         query = query.join(Rating.user)
         query = query.join(Rating.beer)
         query = query.filter(User.username == username, Beer.slug == beer)
+        query = query.filter(User.deleted_at == None, Beer.deleted_at == None)
 
         rating = query.one()
-        return jsonify({'rating': rating.to_dict(include_beer=True, include_user=True)})  
     except NoResultFound:
         abort(404)
 
-    db.session.remove(rating)
+    if rating.user_id != g.user_id:
+        abort(403)
+
+    track_rating(rating, rating.user_id, rating.beer, -1)
+    record_change('rating', 'delete', '%s:%s' % (username, beer))
+    db.session.delete(rating)
     db.session.commit()
     return '', 204
 
 #get ratings of a particular beer
 @app.route('/beers/<string:name>/ratings')
+@cached('Beers:{name}', 'Ratings:{name}', 'Users')
 def get_beer_ratings(name):
     """Returns a list of ratings about a particular beer (by name)."""
     try:
-        beer = Beer.query.filter_by(slug=name).one()
+        beer = Beer.active().filter_by(slug=name).one()
     except NoResultFound:
         abort(404)
 
@@ -744,35 +2174,34 @@ def get_beer_ratings(name):
     except KeyError:
         sort_field = ratings_sort_fields['average']
 
-    ratings = Beer.ratings
+    ratings = beer.ratings
+    ratings = ratings.join(Rating.user)
+    ratings = ratings.filter(User.deleted_at == None)
     ratings = ratings.order_by(sort_field)
     ratings = ratings.all()
     
-    return jsonify({'ratings': [r.to_dict(include_user=True) for r in beer.ratings]})
+    return jsonify({'ratings': [r.to_dict(include_user=True) for r in ratings]})
         
 #add a rating
 @app.route('/ratings', methods=['POST'])
+@login_required
+@touches('Ratings', 'Breweries')
 def create_rating():
-    """Creates a new rating. Requires aroma, appearance, taste, palate, bottle, beer, and user in input json."""
+    """Creates a new rating by the token's user. Requires aroma, appearance, taste, palate, bottle, and beer in input json."""
+    if token_user_deleted():
+        return jsonify({'error': 'missing or invalid token'}), 401
     data = request.get_json(force=True)  
     rating = Rating()
     db.session.add(rating)
 
     try:
-        beer = Beer.query.filter_by(slug=data['beer']).one()
+        beer = Beer.active().filter_by(slug=data['beer']).one()
 
     except (KeyError, NoResultFound) as e:
         return jsonify({'error': 'beer not found or missing values'}), 422
 
-    try:
-        user = User.query.filter_by(username=data['username']).one()
-        beer.created_by = user
-    except (KeyError, NoResultFound) as e:
-        return jsonify({'error': 'user not found or missing values'}), 422
-
     latest = Rating.query
-    latest = latest.join(Rating.user)
-    latest = latest.filter(User.username == data['username'])
+    latest = latest.filter(Rating.user_id == g.user_id)
     latest = latest.order_by(Rating.created_at.desc())
     latest = latest.first()
 
@@ -780,15 +2209,14 @@ def create_rating():
         return jsonify({'error': 'User already created a rating this week', 'rating': latest.to_dict()}), 422
     
     query = Rating.query
-    query = query.join(Rating.user)
-    query = query.join(Rating.beer)
-    query = query.filter(User.username == data['username'], Beer.slug == data['beer'])
+    query = query.filter(Rating.user_id == g.user_id, Rating.beer_id == beer.id)
 
     if query.count():
         return jsonify({'error': 'User already reviewed this beer', 'rating': latest.to_dict()}), 422
 
     rating.beer = beer
-    rating.user = user
+    rating.user_id = g.user_id
+    rating.created_at = datetime.datetime.now()
 
     try:
         rating.aroma = int(data['aroma'])
@@ -815,6 +2243,10 @@ def create_rating():
     except (KeyError, ValueError) as e:
         return jsonify({'error': 'bad format of bottle or missing values'})
 
+    track_rating(rating, g.user_id, beer)
+    touch('Ratings:' + beer.slug)
+    username = db.session.query(User.username).filter(User.id == g.user_id).scalar()
+    record_change('rating', 'create', '%s:%s' % (username, beer.slug), rating.to_dict())
     db.session.commit()
     return '', 201
 
@@ -829,35 +2261,45 @@ def create_rating():
 @app.route('/users/<string:username>/favorites')
 def get_favorites(username):
     try:
-        user = User.query.filter_by(username=username).one() 
+        user = User.active().filter_by(username=username).one() 
 
-        return jsonify({'beers':[b.to_dict() for b in user.favorite_beers.all()]})
+        return jsonify({'beers':[b.to_dict() for b in user.favorite_beers.filter(Beer.deleted_at == None).all()]})
     except NoResultFound:
         abort(404)
 
 #add particular beer to a user's favorite list
 @app.route('/users/<string:username>/favorites/<string:beer>', methods=['PUT'])
+@login_required
 def create_favorites(username, beer):
     try:
-        user = User.query.filter_by(username=username).one()
-        beer=Beer.query.filter_by(slug=beer).one() 
+        user = User.active().filter_by(username=username).one()
+        beer=Beer.active().filter_by(slug=beer).one() 
     except NoResultFound:
         abort(404)
 
+    if user.id != g.user_id:
+        abort(403)
+
     user.favorite_beers.append(beer)
+    record_change('favorite', 'create', '%s:%s' % (user.username, beer.slug))
     db.session.commit()
     return '', 201
 
 #delete beer from a user's favorite list
 @app.route('/users/<string:username>/favorites/<string:beer>', methods=['DELETE'])
+@login_required
 def delete_favorties(username, beer):
     try:
-        user = User.query.filter_by(username=username).one()
-        beer=Beer.query.filter_by(slug=beer).one() 
+        user = User.active().filter_by(username=username).one()
+        beer=Beer.active().filter_by(slug=beer).one() 
     except NoResultFound:
         abort(404)
 
+    if user.id != g.user_id:
+        abort(403)
+
     user.favorite_beers.remove(beer)
+    record_change('favorite', 'delete', '%s:%s' % (user.username, beer.slug))
     db.session.commit()
     return '', 204
 
@@ -867,4 +2309,54 @@ def delete_favorties(username, beer):
 
 
 
-    
\ No newline at end of file
+    
+
+#---------------------------------------------------------------
+#changes
+
+@app.route('/changes')
+def changes():
+    """Returns changes after a cursor (since=<id> or Last-Event-ID).
+
+    Clients accepting text/event-stream get a server-sent event stream;
+    everyone else gets one long-polled batch, waiting up to wait seconds
+    (0 to 60). Each open request holds a worker thread unless the app runs
+    under gevent or eventlet, so past CHANGE_FEED_MAX_SUBSCRIBERS open
+    requests this process answers 503.
+    """
+    try:
+        cursor = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+        wait = float(request.args.get('wait', 25))
+        if math.isinf(wait) or math.isnan(wait):
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'bad format in since or wait'}), 422
+    wait = max(0, min(wait, 60))
+
+    if not change_feed.subscribe():
+        response = jsonify({'error': 'too many change feed subscribers, try again shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+
+    if request.accept_mimetypes.best != 'text/event-stream':
+        try:
+            batch = change_feed.read(cursor, wait)
+        finally:
+            change_feed.unsubscribe()
+        return jsonify({'changes': batch, 'cursor': batch[-1]['id'] if batch else cursor})
+
+    def stream(cursor):
+        while True:
+            batch = change_feed.read(cursor, 15)
+            if not batch:
+                yield ': keep-alive\n\n'
+            for change in batch:
+                cursor = change['id']
+                yield 'id: %d\nevent: %s\ndata: %s\n\n' % (cursor, change['kind'], json.dumps(change))
+
+    response = Response(stream_with_context(stream(cursor)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    #runs when the server closes the response, even if the stream never started
+    response.call_on_close(change_feed.unsubscribe)
+    return response
@@ -1,8 +1,16 @@
 # manage.py
 
-from flask.ext.script import Manager
+import time
+import datetime
+import threading
+from multiprocessing import cpu_count
 
-from beer import app, db, User, Beer, Rating, Glass
+import sqlalchemy
+from sqlalchemy.schema import CreateColumn
+from flask.ext.script import Manager, Command
+
+import snapshot
+from beer import app, db, User, Beer, Rating, Glass, Brewery, TasteProfile, RatingRollup, Change, hash_password, verify_password, purge_tombstones
 
 manager = Manager(app)
 
@@ -16,9 +24,13 @@ def initdb():
 
     g1 = Glass(glass_name='standard')
 
-    b1 = Beer(created_by=u1, name='Sotted Cow', ibu=20,calories=100,abv=12,brewery='pabst', glass=g1)
-    b2 = Beer(created_by=u2, name='Newcastle', ibu=30,calories=200,abv=24,brewery='new glarus', glass=g1)
-    b3 = Beer(created_by=u1, name='Hebrew The Chosen Beer', ibu=40,calories=300,abv=36,brewery='miller', glass=g1)
+    br1 = Brewery(brewery_name='pabst')
+    br2 = Brewery(brewery_name='new glarus')
+    br3 = Brewery(brewery_name='miller')
+
+    b1 = Beer(created_by=u1, name='Sotted Cow', ibu=20,calories=100,abv=12,brewery=br1, glass=g1)
+    b2 = Beer(created_by=u2, name='Newcastle', ibu=30,calories=200,abv=24,brewery=br2, glass=g1)
+    b3 = Beer(created_by=u1, name='Hebrew The Chosen Beer', ibu=40,calories=300,abv=36,brewery=br3, glass=g1)
 
     r1 = Rating(user=u1, beer=b1, aroma=5, appearance=5, taste=5, palate=5, bottle=4)
     r2 = Rating(user=u2, beer=b2, aroma=4, appearance=4, taste=4, palate=4, bottle=5)
@@ -38,6 +50,156 @@ def initdb():
 
     db.session.commit()
 
+    rebuild_aggregates()
+
+@manager.command
+def rebuild_aggregates():
+    """Recomputes the incrementally maintained aggregates from the raw tables."""
+    TasteProfile.rebuild()
+    RatingRollup.rebuild()
+    Brewery.rebuild()
+    db.session.commit()
+
+def _upgrade_schema():
+    """Creates missing tables, then adds the columns and indexes the models have
+    but existing tables lack. Added columns must be nullable. Returns what was added."""
+    db.create_all()
+    inspector = sqlalchemy.inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            spec = str(CreateColumn(column).compile(dialect=db.engine.dialect))
+            for fk in column.foreign_keys:
+                spec += ' REFERENCES "%s" (%s)' % (fk.column.table.name, fk.column.name)
+                if fk.ondelete:
+                    spec += ' ON DELETE ' + fk.ondelete
+            db.session.execute('ALTER TABLE "%s" ADD COLUMN %s' % (table.name, spec))
+            added.append('%s.%s' % (table.name, column.name))
+
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(db.session.connection())
+                added.append(index.name)
+    return added
+
+@manager.command
+def migrate_tombstones():
+    """Upgrades an existing database for soft deletes: deleted_at columns, the indexes purging uses, and cascading rating foreign keys."""
+    for name in _upgrade_schema():
+        print('added %s' % name)
+
+    if db.engine.dialect.name == 'postgresql':
+        for fk in sqlalchemy.inspect(db.engine).get_foreign_keys('Ratings'):
+            if (fk.get('options') or {}).get('ondelete', '').upper() == 'CASCADE':
+                continue
+            db.session.execute('ALTER TABLE "Ratings" DROP CONSTRAINT "%s"' % fk['name'])
+            db.session.execute('ALTER TABLE "Ratings" ADD CONSTRAINT "%s" FOREIGN KEY (%s) REFERENCES "%s" (%s) ON DELETE CASCADE'
+                               % (fk['name'], fk['constrained_columns'][0], fk['referred_table'], fk['referred_columns'][0]))
+            print('%s now cascades' % fk['name'])
+    else:
+        #sqlite cannot alter constraints; the purge deletes ratings itself anyway
+        print('%s: rating foreign keys left as they are' % db.engine.dialect.name)
+
+    db.session.commit()
+
+@manager.command
+def migrate_breweries():
+    """Moves the free-form Beers.brewery strings into Breweries, merging names that share a slug."""
+    columns = [c['name'] for c in sqlalchemy.inspect(db.engine).get_columns('Beers')]
+    #adds brewery_id, and the soft-delete columns the rebuild below reads on databases older than those
+    migrate_tombstones()
+
+    if 'brewery' in columns:
+        names = db.session.execute('SELECT DISTINCT brewery FROM "Beers" WHERE brewery_id IS NULL AND brewery IS NOT NULL').fetchall()
+        for name, in names:
+            if not name.strip():
+                continue
+            brewery = Brewery.for_name(name)
+            db.session.flush()
+            db.session.execute('UPDATE "Beers" SET brewery_id = :brewery_id WHERE brewery = :name AND brewery_id IS NULL',
+                               {'brewery_id': brewery.id, 'name': name})
+        print('%d brewery names merged into %d breweries' % (len(names), Brewery.query.count()))
+        print('the old "Beers".brewery column is no longer read and can be dropped')
+
+    #taste profiles key favorite breweries by the merged names too
+    rebuild_aggregates()
+
+@manager.command
+def prune_rollups(days=90):
+    """Drops rating rollups older than days. Trending never looks back further than 30, and Ratings keeps the history."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=int(days))
+    deleted = RatingRollup.query.filter(RatingRollup.bucket < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    print('%d rollups removed' % deleted)
+
+@manager.command
+def prune_changes(days=7):
+    """Drops change log entries older than days; consumers further behind must resync."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=int(days))
+    deleted = Change.query.filter(Change.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    print('%d changes removed' % deleted)
+
+@manager.command
+def purge(batch_size=1000):
+    """Removes tombstoned users and beers now instead of waiting for the purger thread."""
+    purge_tombstones(int(batch_size))
+
+@manager.command
+def export(path, chunk_size=50000):
+    """Writes a compressed columnar snapshot of the dataset to path."""
+    counts = snapshot.export(path, int(chunk_size))
+    for name in snapshot.TABLES:
+        print('%s: %d rows' % (name, counts[name]))
+
+def import_snapshot(path):
+    """Loads a snapshot written by export into an empty database."""
+    db.create_all()
+    counts = snapshot.load(path)
+    for name in snapshot.TABLES:
+        print('%s: %d rows' % (name, counts.get(name, 0)))
+    rebuild_aggregates()
+
+#'import' is a keyword, so this one is registered by hand
+manager.add_command('import', Command(import_snapshot))
+
+@manager.command
+def bench_passwords(seconds=5):
+    """Measures login (password verification) throughput, single threaded and through the pool."""
+    seconds = float(seconds)
+    workers = app.config['PASSWORD_HASH_WORKERS'] or cpu_count()
+    stored = hash_password('benchmark')
+
+    def run(callers):
+        done = [0]
+        lock = threading.Lock()
+        deadline = time.time() + seconds
+
+        def caller():
+            while time.time() < deadline:
+                verify_password('benchmark', stored)
+                with lock:
+                    done[0] += 1
+
+        threads = [threading.Thread(target=caller) for i in range(callers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return done[0] / seconds
+
+    single = run(1)
+    #twice as many callers as pool slots, like a busy server
+    pooled = run(workers * 2)
+
+    print('pbkdf2_sha256, %d iterations, %d pool workers on %d cores' % (app.config['PASSWORD_HASH_ITERATIONS'], workers, cpu_count()))
+    print('single caller: %.1f logins/s' % single)
+    print('pooled:        %.1f logins/s (%.1f per core)' % (pooled, pooled / min(workers, cpu_count())))
+
 @manager.command
 def dropdb():
     db.drop_all()
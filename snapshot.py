@@ -0,0 +1,163 @@
+# snapshot.py
+#
+# Streams whole tables to and from a compact columnar snapshot file.
+#
+# A snapshot is a gzip stream of json lines. The first line is a header; every
+# other line is one chunk of one table, stored column-wise:
+#
+#   {"table": "Users", "columns": ["id", "email", ...], "data": [[1, 2, ...], ["a@b", ...], ...]}
+#
+# Storing chunks column-wise keeps similar values next to each other, which
+# gzip compresses far better than row-wise json. Export and import both hold
+# at most one chunk in memory.
+
+import gzip
+import json
+import datetime
+from cStringIO import StringIO
+
+from sqlalchemy import select, func, case
+
+from beer import db
+
+FORMAT = 'beer-snapshot'
+#bumped whenever a table's columns change; 2 moved Beers.brewery into Breweries
+VERSION = 2
+
+#parents before children, so foreign keys resolve during import
+TABLES = ['Users', 'Glasses', 'Breweries', 'Beers', 'Ratings', 'Favorites']
+
+def _encode(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+def _decoder(column):
+    if isinstance(column.type, db.DateTime):
+        return lambda v: v and datetime.datetime.strptime(v, '%Y-%m-%dT%H:%M:%S.%f' if '.' in v else '%Y-%m-%dT%H:%M:%S')
+    return lambda v: v
+
+def export(path, chunk_size=50000):
+    """Writes every table in TABLES to a snapshot at path. Returns {table: row count}."""
+    counts = {}
+    with gzip.open(path, 'wb') as out:
+        out.write(json.dumps({'format': FORMAT, 'version': VERSION, 'tables': TABLES}) + '\n')
+
+        connection = db.engine.connect().execution_options(stream_results=True)
+        try:
+            for name in TABLES:
+                table = db.metadata.tables[name]
+                columns = [c.name for c in table.columns]
+                order = list(table.primary_key.columns) or list(table.columns)
+                result = connection.execute(table.select().order_by(*order))
+                counts[name] = 0
+
+                while True:
+                    rows = result.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    data = [[_encode(row[i]) for row in rows] for i in range(len(columns))]
+                    out.write(json.dumps({'table': name, 'columns': columns, 'data': data}, separators=(',', ':')) + '\n')
+                    counts[name] += len(rows)
+        finally:
+            connection.close()
+    return counts
+
+def _csv_field(value):
+    """Formats one value for COPY ... CSV, where only a bare empty field reads back as NULL."""
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        #quoted, so an empty string stays an empty string
+        return '"%s"' % value.replace('"', '""')
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _copy(connection, table, columns, rows):
+    """Loads rows with postgres COPY, which skips per-row statement overhead."""
+    buf = StringIO()
+    for row in rows:
+        buf.write(','.join(_csv_field(v) for v in row) + '\n')
+    buf.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY "%s" (%s) FROM STDIN WITH CSV' % (table.name, ', '.join('"%s"' % c for c in columns)), buf)
+    finally:
+        cursor.close()
+
+def _check_nulls(connection, nulls):
+    """Raises ValueError unless each column holds as many NULLs as the snapshot did."""
+    for name in sorted(set(name for name, _ in nulls)):
+        table = db.metadata.tables[name]
+        columns = sorted(column for table_name, column in nulls if table_name == name)
+        found = connection.execute(select([func.coalesce(func.sum(case([(table.columns[c] == None, 1)], else_=0)), 0)
+                                           for c in columns])).first()
+        for column, count in zip(columns, found):
+            if count != nulls[(name, column)]:
+                raise ValueError('%s.%s has %d NULLs after import, the snapshot had %d'
+                                 % (name, column, count, nulls[(name, column)]))
+
+def load(path):
+    """Loads a snapshot into empty tables. Returns {table: row count}.
+
+    Secondary indexes are dropped for the duration of the load and built once
+    at the end, which is much cheaper than maintaining them row by row.
+    """
+    counts = {}
+    nulls = {}      #(table, nullable column) -> NULLs in the snapshot
+    with gzip.open(path, 'rb') as snapshot:
+        header = json.loads(snapshot.readline())
+        if header.get('format') != FORMAT:
+            raise ValueError('%s is not a snapshot' % path)
+        if header.get('version') != VERSION:
+            raise ValueError('%s is a version %s snapshot, this release only imports version %d; '
+                             'load it with the release that wrote it and upgrade that database instead'
+                             % (path, header.get('version'), VERSION))
+
+        tables = [db.metadata.tables[name] for name in header['tables']]
+        postgres = db.engine.dialect.name == 'postgresql'
+
+        with db.engine.begin() as connection:
+            for table in tables:
+                if connection.execute(table.count()).scalar():
+                    raise ValueError('table %s is not empty' % table.name)
+
+            indexes = [index for table in tables for index in table.indexes]
+            for index in indexes:
+                index.drop(connection)
+
+            for line in snapshot:
+                chunk = json.loads(line)
+                table = db.metadata.tables[chunk['table']]
+                columns = chunk['columns']
+                decoders = [_decoder(table.columns[c]) for c in columns]
+                rows = zip(*[[decode(v) for v in values] for decode, values in zip(decoders, chunk['data'])])
+
+                for column, values in zip(columns, chunk['data']):
+                    if table.columns[column].nullable:
+                        nulls[(table.name, column)] = nulls.get((table.name, column), 0) + values.count(None)
+
+                if postgres:
+                    _copy(connection, table, columns, rows)
+                else:
+                    connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+                counts[table.name] = counts.get(table.name, 0) + len(rows)
+
+            for index in indexes:
+                index.create(connection)
+
+            if postgres:
+                #COPY is the path that can lose NULLs, so read them back before committing
+                _check_nulls(connection, nulls)
+
+                #explicit ids were loaded, so move each serial sequence past them
+                for table in tables:
+                    for column in table.primary_key.columns:
+                        if column.autoincrement and isinstance(column.type, db.Integer):
+                            connection.execute('SELECT setval(pg_get_serial_sequence(\'"%s"\', \'%s\'), coalesce(max("%s"), 1)) FROM "%s"'
+                                               % (table.name, column.name, column.name, table.name))
+    return counts